@@ -1,13 +1,16 @@
 from .bot import Bot
+from .update_queue import UpdateQueue, run_pipeline
 from .utils import (
     KeyboardButton, InlineKeyboardButton, URLKeyboardButton, RemoveKeyboardButton, Photo, Video, Audio, Voice, Sticker,
-    Document, Message
+    Document, File, Message, TelegramError, TelegramAPIError, NetworkError, CircuitOpenError
 )
 
 __all__ = [
     "Bot",
-    "Photo", "Video", "Audio", "Voice", "Sticker", "Document",
+    "Photo", "Video", "Audio", "Voice", "Sticker", "Document", "File",
     "KeyboardButton", "RemoveKeyboardButton", "InlineKeyboardButton", "URLKeyboardButton",
     "Message",
+    "TelegramError", "TelegramAPIError", "NetworkError", "CircuitOpenError",
+    "UpdateQueue", "run_pipeline",
     "botbuilder"
 ]
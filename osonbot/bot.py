@@ -1,10 +1,17 @@
 import os
-import httpx
+import time
+import uuid
+import shutil
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Callable, Optional
 from .database import Database
+from .update_queue import UpdateQueue
+from .transport import Transport
 from .utils import (
-    FileNotFoundOrInvalidURLError, 
-    Photo, Video, Audio, Voice, Document, Sticker,
+    TelegramAPIError, CircuitOpenError,
+    Photo, Video, Audio, Voice, Document, Sticker, File,
     setup_logger, 
     InlineKeyboardButton, RemoveKeyboardButton, URLKeyboardButton, KeyboardButton,
     Message
@@ -12,11 +19,23 @@ from .utils import (
 
 
 class Bot:
-    def __init__(self, token, auto_db: bool = True, db_name: str = "database.db", admin_id: int = None):
-        self.api_url = f"https://api.telegram.org/bot{token}/"
+    media_types = {"photo": Photo, "video": Video, "audio": Audio, "voice": Voice, "sticker": Sticker, "document": Document}
+
+    def __init__(
+        self, token, auto_db: bool = True, db_name: str = "database.db", admin_id: int = None, cache_dir: str = "files", max_downloads: int = 4,
+        base_url: str = "https://api.telegram.org", retries: int = 3, timeouts: dict = None, max_retry_after: float = 30
+    ):
+        self.logger = setup_logger("osonbot")
+        self.transport = Transport(token, base_url, retries=retries, timeouts=timeouts, max_retry_after=max_retry_after, logger=self.logger)
+        self.api_url = self.transport.api_url
+        self.file_url = self.transport.file_url
+        self.cache_dir = cache_dir
+        self.max_downloads = max_downloads
+        self._download_slots = threading.BoundedSemaphore(max_downloads)
+        self._download_locks = {}
+        self._download_locks_guard = threading.Lock()
         self.handlers = {}
         self.callback_handlers = {}
-        self.logger = setup_logger("osonbot")
         self.auto_db = auto_db
         self.admin_id = admin_id
         if auto_db:
@@ -40,8 +59,8 @@ class Bot:
             else:
                 self.callback_handlers[condition] = {'text': text, "parse_mode": parse_mode, "reply_markup": reply_markup}
 
-    def get_updates(self, offset: int):
-        return httpx.get(self.api_url+"getUpdates", params={'offset': offset}).json()
+    def get_updates(self, offset: int, timeout: int = 0):
+        return self.transport.call("getUpdates", {'offset': offset, 'timeout': timeout}, timeout=timeout + 10)
     
     def send_message(self, chat_id, text: str, parse_mode: str = None, reply_markup: Union[KeyboardButton, InlineKeyboardButton, URLKeyboardButton, None] = None):
         params = {'chat_id': chat_id, "text": text}
@@ -49,116 +68,41 @@ class Bot:
             params['parse_mode'] = parse_mode
         if reply_markup:
             params['reply_markup'] = reply_markup
-        return httpx.post(self.api_url+"sendMessage", json=params).json()['result']
+        return self.transport.call("sendMessage", params)
+
+    def _send_media(self, method: str, field: str, chat_id, media: str, caption: str = None, reply_markup=None, parse_mode: str = None):
+        params = {"chat_id": chat_id, 'caption': caption}
+        if reply_markup:
+            params['reply_markup'] = reply_markup
+        if parse_mode:
+            params['parse_mode'] = parse_mode
+        if os.path.exists(media):
+            with open(media, 'rb') as f:
+                return self.transport.call(method, data=params, files={field: f})
+        # URLs and file_ids of files already on Telegram are sent as they are
+        params[field] = media
+        return self.transport.call(method, params)
     
     def send_photo(self, chat_id, photo: str, caption: str = None, reply_markup: Union[KeyboardButton, InlineKeyboardButton, URLKeyboardButton, None] = None, parse_mode: str = None):
-        try:
-            if os.path.exists(photo):
-                data = {"chat_id": chat_id, 'caption': caption}
-                if reply_markup:
-                    data['reply_markup'] = reply_markup
-                if parse_mode:
-                    data['parse_mode'] = parse_mode
-                with open(photo, 'rb') as p:
-                    return httpx.post(self.api_url+"sendPhoto", data=data, files={"photo": p}).json()
-            elif "https://" in photo or "http://" in photo:
-                json = {"chat_id": chat_id, "photo": photo, 'caption': caption}
-                if reply_markup:
-                    json['reply_markup'] = reply_markup
-                if parse_mode:
-                    json['parse_mode'] = parse_mode
-                return httpx.post(self.api_url+"sendPhoto", json=json).json()
-            else:
-                raise FileNotFoundOrInvalidURLError(f"Photo not found or invalid URL: {photo}")
-        except:
-            self.logger.error("Error occured: ", exc_info=True)
+        return self._send_media("sendPhoto", "photo", chat_id, photo, caption, reply_markup, parse_mode)
 
     def send_video(self, chat_id, video: str, caption, reply_markup: Union[KeyboardButton, InlineKeyboardButton, URLKeyboardButton, None] = None, parse_mode: str = None):
-        try:
-            if os.path.exists(video):
-                data = {"chat_id": chat_id, 'caption': caption}
-                if reply_markup:
-                    data['reply_markup'] = reply_markup
-                if parse_mode:
-                    data['parse_mode'] = parse_mode
-                with open(video, 'rb') as v:
-                    return httpx.post(self.api_url+"sendVideo", data=data, files={"video": v}).json()['result']
-            elif "https://" in video or "http://" in video:
-                json = {"chat_id": chat_id, "video": video, 'caption': caption}
-                if reply_markup:
-                    json['reply_markup'] = reply_markup
-                if parse_mode:
-                    json['parse_mode'] = parse_mode
-                return httpx.post(self.api_url+"sendVideo", json=json).json()['result']
-            else:
-                raise FileNotFoundOrInvalidURLError(f"Video not found or invalid URL: {video}")
-        except:
-            self.logger.error("Error occured: ", exc_info=True)
+        return self._send_media("sendVideo", "video", chat_id, video, caption, reply_markup, parse_mode)
 
     def send_audio(self, chat_id, audio: str, caption, reply_markup: Union[KeyboardButton, InlineKeyboardButton, URLKeyboardButton, None] = None, parse_mode: str = None):
-        try:
-            if os.path.exists(audio):
-                data = {"chat_id": chat_id, 'caption': caption}
-                if reply_markup:
-                    data['reply_markup'] = reply_markup
-                if parse_mode:
-                    data['parse_mode'] = parse_mode
-                with open(audio, 'rb') as a:
-                    return httpx.post(self.api_url+"sendAudio", data=data, files={"audio": a}).json()['result']
-            elif "https://" in audio or "http://" in audio:
-                json = {"chat_id": chat_id, "audio": audio, 'caption': caption, 'reply_markup': reply_markup}
-                if reply_markup:
-                    json['reply_markup'] = reply_markup
-                if parse_mode:
-                    json['parse_mode'] = parse_mode
-                return httpx.post(self.api_url+"sendAudio", json=json).json()['result']
-            else:
-                raise FileNotFoundOrInvalidURLError(f"Audio not found or invalid URL: {audio}")
-        except:
-            self.logger.error("Error occured: ", exc_info=True)
+        return self._send_media("sendAudio", "audio", chat_id, audio, caption, reply_markup, parse_mode)
     
     def send_voice(self, chat_id, voice: str, caption, reply_markup: Union[KeyboardButton, InlineKeyboardButton, URLKeyboardButton, None] = None, parse_mode: str = None):
-        try:
-            if os.path.exists(voice):
-                data = {"chat_id": chat_id, 'caption': caption}
-                if reply_markup:
-                    data['reply_markup'] = reply_markup
-                if parse_mode:
-                    data['parse_mode'] = parse_mode
-                with open(voice, 'rb') as v:
-                    return httpx.post(self.api_url+"sendVoice", data=data, files={"voice": v}).json()['result']
-            else:
-                raise FileNotFoundError(f"file {voice} not found. Make sure it exists")
-        except:
-            self.logger.error("Error occured: ", exc_info=True)
+        return self._send_media("sendVoice", "voice", chat_id, voice, caption, reply_markup, parse_mode)
     
     def send_sticker(self, chat_id, sticker: str, reply_markup: dict = None):
         params = {"chat_id": chat_id, "sticker": sticker}
         if reply_markup:
             params['reply_markup'] = reply_markup
-        return httpx.post(self.api_url + "sendSticker", json=params).json()['result']
+        return self.transport.call("sendSticker", params)
     
     def send_document(self, chat_id, document: str, caption: str = None, parse_mode: str = None, reply_markup: Union[KeyboardButton, InlineKeyboardButton, URLKeyboardButton, None] = None):
-        try:
-            if os.path.exists(document):
-                data = {"chat_id": chat_id, 'caption': caption}
-                if reply_markup:
-                    data['reply_markup'] = reply_markup
-                if parse_mode:
-                    data['parse_mode'] = parse_mode
-                with open(document, 'rb') as v:
-                    return httpx.post(self.api_url+"senddocument", data=data, files={"document": v}).json()['result']
-            elif "https://" in document or "http://" in document:
-                json = {"chat_id": chat_id, "document": document, 'caption': caption}
-                if reply_markup:
-                    json['reply_markup'] = reply_markup
-                if parse_mode:
-                    json['parse_mode'] = parse_mode
-                return httpx.post(self.api_url+"senddocument", json=json).json()['result']
-            else:
-                raise FileNotFoundOrInvalidURLError(f"document not found or invalid URL: {document}")
-        except:
-            self.logger.error("Error occured: ", exc_info=True)
+        return self._send_media("sendDocument", "document", chat_id, document, caption, reply_markup, parse_mode)
 
     def edit_message_text(self, chat_id: int, message_id: int, text: str, parse_mode: str = None, reply_markup: Union[KeyboardButton, InlineKeyboardButton, URLKeyboardButton, None] = None):
         params = {'chat_id': chat_id, 'message_id': message_id, 'text': text}
@@ -166,15 +110,106 @@ class Bot:
             params['parse_mode'] = parse_mode
         if reply_markup:
             params['reply_markup'] = reply_markup
-        return httpx.post(self.api_url + "editMessageText", json=params).json()['result']
-    
+        return self.transport.call("editMessageText", params)
+
+    def get_file(self, file_id: str):
+        return self.transport.call("getFile", {'file_id': file_id})
+
+    def _cache_path(self, file_unique_id: str):
+        return os.path.join(self.cache_dir, file_unique_id)
+
+    @contextmanager
+    def _download_lock(self, file_unique_id: str):
+        # Locks are counted and dropped when nobody holds or waits for them, so the dict does not grow forever
+        with self._download_locks_guard:
+            entry = self._download_locks.setdefault(file_unique_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._download_locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._download_locks[file_unique_id]
+
+    def _stream(self, file_path: str, out, chunk_size: int):
+        with self._download_slots:
+            with self.transport.stream(file_path) as response:
+                for chunk in response.iter_bytes(chunk_size):
+                    out.write(chunk)
+
+    def _deliver(self, source: str, destination):
+        if hasattr(destination, "write"):
+            with open(source, 'rb') as f:
+                shutil.copyfileobj(f, destination)
+            return destination
+        shutil.copyfile(source, destination)
+        return destination
+
+    def download(self, file: Union[str, File], destination=None, chunk_size: int = 64 * 1024):
+        """
+        Download a file sent to the bot.
+
+        Args:
+            file: file_id or a File handle
+            destination: Path or writable binary buffer. If omitted, the path of the cached copy is returned
+            chunk_size: Bytes read per chunk, memory use stays around this size
+
+        Files are cached in `cache_dir` by their file_unique_id, so the same media is only downloaded once.
+        Set `cache_dir=None` to always stream straight to `destination`.
+        """
+        if isinstance(file, str):
+            file = File(self, file)
+
+        if self.cache_dir is None:
+            if destination is None:
+                raise ValueError("destination is required when cache_dir is None")
+            info = self.get_file(file.file_id)
+            if hasattr(destination, "write"):
+                self._stream(info['file_path'], destination, chunk_size)
+            else:
+                with open(destination, 'wb') as out:
+                    self._stream(info['file_path'], out, chunk_size)
+            return destination
+
+        info = None
+        if file.file_unique_id is None:
+            info = self.get_file(file.file_id)
+            file.file_unique_id = info['file_unique_id']
+
+        cached = self._cache_path(file.file_unique_id)
+        # Only one thread downloads a given file, the others wait and reuse it
+        with self._download_lock(file.file_unique_id):
+            if not os.path.exists(cached):
+                info = info or self.get_file(file.file_id)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = f"{cached}.{uuid.uuid4().hex}.part"
+                try:
+                    with open(tmp, 'wb') as out:
+                        self._stream(info['file_path'], out, chunk_size)
+                    os.replace(tmp, cached)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+
+        if destination is None:
+            return cached
+        return self._deliver(cached, destination)
+
+    def download_many(self, files: list[Union[str, File]], destinations: list = None):
+        """Download several files at once, at most `max_downloads` at a time. Returns results in the same order."""
+        destinations = destinations or [None] * len(files)
+        with ThreadPoolExecutor(max_workers=self.max_downloads) as executor:
+            return list(executor.map(self.download, files, destinations))
+
     def formatter(self, text: str, message):
         try:
             return text.format(
                     first_name=message['from']['first_name'],
                     last_name=message['from']['last_name'],
                     full_name=f"{message['from']['first_name']} {message['from']['last_name']}",
-                    message_text=message['text'],
+                    message_text=message.get('text', message.get('caption', '')),
                     user_id=message['from']['id'],
                     message_id=message['message_id']
                 )
@@ -184,7 +219,7 @@ class Bot:
                         first_name=message['chat']['first_name'] if 'first_name' in message['chat'] else "",
                         last_name=message['chat']['last_name'] if 'last_name' in message['chat'] else "",
                         full_name=f"{message['chat']['first_name'] if 'first_name' in message['chat'] else ''} {message['chat']['last_name'] if 'last_name' in message['chat'] else ''}",
-                        message_text=message['text'],
+                        message_text=message.get('text', message.get('caption', '')),
                         user_id=message['from']['id'],
                         message_id=message['message_id']
                     )
@@ -192,7 +227,7 @@ class Bot:
                 return text
     
     def get_me(self):
-        return httpx.get(self.api_url + "getMe").json()
+        return self.transport.call("getMe")
 
     def process_callback(self, callback):
         message = callback.get("message", {})
@@ -220,71 +255,120 @@ class Bot:
             text = message.get("text", "")
             chat_id = message['chat']['id']
             handled = self.handlers.get(text) or self.handlers.get("*")
-
             if not handled:
                 return
-            
-            if callable(handled['text']):
-                returned = handled['text'](message)
-                if isinstance(returned, Photo):
-                    self.send_photo(chat_id, returned.url, caption=self.formatter(returned.caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-                elif isinstance(returned, Video):
-                    self.send_video(chat_id, returned.url, caption=self.formatter(returned.caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-                elif isinstance(returned, Audio):
-                    self.send_audio(chat_id, returned.url, caption=self.formatter(returned.caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-                elif isinstance(returned, Voice):
-                    self.send_voice(chat_id, returned.url, caption=self.formatter(returned.caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-                elif isinstance(returned, Sticker):
-                    self.send_sticker(chat_id, returned.file_id, reply_markup=handled['reply_markup'])
-                elif isinstance(returned, str):
-                    self.send_message(chat_id, self.formatter(returned, message), parse_mode=handled['parse_mode'], reply_markup=handled['reply_markup'])
-                elif isinstance(returned, Document):
-                    self.send_document(chat_id, returned.file_id, caption=self.formatter(returned.caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-            
-            if isinstance(handled['text'], Photo):
-                self.send_photo(chat_id, self.formatter(handled['text'].url, message), caption=self.formatter(handled['text'].caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-            elif isinstance(handled['text'], Video):
-                self.send_video(chat_id, self.formatter(handled['text'].url, message), caption=self.formatter(handled['text'].caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-            elif isinstance(handled['text'], Audio):
-                self.send_audio(chat_id, self.formatter(handled['text'].url, message), caption=self.formatter(handled['text'].caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-            elif isinstance(handled['text'], Voice):
-                self.send_voice(chat_id, self.formatter(handled['text'].url, message), caption=self.formatter(handled['text'].caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-            elif isinstance(handled['text'], Sticker):
-                self.send_sticker(chat_id, handled['text'].file_id, reply_markup=handled['reply_markup'])
-            elif isinstance(handled['text'], str):
-                self.send_message(chat_id, self.formatter(handled['text'], message), parse_mode=handled['parse_mode'], reply_markup=handled['reply_markup'])
-            elif isinstance(returned, Document):
-                self.send_document(chat_id, returned.file_id, caption=self.formatter(returned.caption, message), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
-        
-        elif "photo" in message:
-            hv = self.handlers.get(Photo)
-            self.send_message(chat_id, hv['text'], parse_mode=hv['parse_mode'], reply_markup=hv['reply_markup'])
-        elif "video" in message:
-            hv = self.handlers.get(Video)
-            self.send_message(chat_id, hv['text'], parse_mode=hv['parse_mode'], reply_markup=hv['reply_markup'])
-        elif "sticker" in message:
-            hv = self.handlers.get(Sticker)
-            self.send_message(chat_id, hv['text'], parse_mode=hv['parse_mode'], reply_markup=hv['reply_markup'])
-        elif "document" in message:
-            hv = self.handlers.get(Document)
-            self.send_message(chat_id, hv['text'], parse_mode=hv['parse_mode'], reply_markup=hv['reply_markup'])
+            self.reply(chat_id, handled, message)
+            return
+
+        for key, media_type in self.media_types.items():
+            if key in message:
+                handled = self.handlers.get(media_type)
+                if not handled:
+                    return
+                message['file'] = File.from_message(self, message[key])
+                self.reply(message['chat']['id'], handled, message)
+                return
+
+    def reply(self, chat_id, handled, message):
+        """Send the answer registered with `when`. Callables are called with the message first."""
+        answer = handled['text'](message) if callable(handled['text']) else handled['text']
+        formatter = lambda text: self.formatter(text, message)
+        if isinstance(answer, Photo):
+            self.send_photo(chat_id, formatter(answer.url), caption=formatter(answer.caption), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
+        elif isinstance(answer, Video):
+            self.send_video(chat_id, formatter(answer.url), caption=formatter(answer.caption), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
+        elif isinstance(answer, Audio):
+            self.send_audio(chat_id, formatter(answer.url), caption=formatter(answer.caption), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
+        elif isinstance(answer, Voice):
+            self.send_voice(chat_id, formatter(answer.url), caption=formatter(answer.caption), reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
+        elif isinstance(answer, Sticker):
+            self.send_sticker(chat_id, answer.file_id, reply_markup=handled['reply_markup'])
+        elif isinstance(answer, Document):
+            self.send_document(chat_id, answer.file_id, reply_markup=handled['reply_markup'], parse_mode=handled['parse_mode'])
+        elif isinstance(answer, str):
+            self.send_message(chat_id, formatter(answer), parse_mode=handled['parse_mode'], reply_markup=handled['reply_markup'])
     
-    def run(self):
-        getme = self.get_me()
+    def process_update(self, update):
+        if "callback_query" in update:
+            self.process_callback(update['callback_query'])
+        elif "message" in update:
+            self.process_messages(update['message'])
+
+    def _log_started(self):
         try:
-            self.logger.info(f"[@{getme['result']['username']} - id={getme['result']['id']}] successfully started")
-        except:
+            getme = self.get_me()
+        except TelegramAPIError:
             raise Exception(f"No telegram bot found based on the token")
+        self.logger.info(f"[@{getme['username']} - id={getme['id']}] successfully started")
+
+    def run(self):
+        self._log_started()
         offset = 0
         while True:
             try:
-                for update in self.get_updates(offset).get("result", []):
-                    offset = update['update_id'] + 1
-
-                    if "callback_query" in update:
-                        self.process_callback(update['callback_query'])
-                    elif "message" in update:
-                        self.process_messages(update['message'])
-                    
+                updates = self.get_updates(offset, timeout=30)
+            except CircuitOpenError as e:
+                time.sleep(e.retry_in)
+                continue
             except Exception as e:
                 self.logger.error("Error occured", exc_info=True)
+                time.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update['update_id'] + 1
+                # One failing update must not stop the rest of the batch
+                try:
+                    self.process_update(update)
+                except Exception as e:
+                    self.logger.error("Error occured", exc_info=True)
+
+    def run_fetcher(self, queue_path: str = "updates.db", poll_timeout: int = 30):
+        """
+        Only fetch updates and store them in the queue at `queue_path`, handlers are not run.
+        Run workers with `run_worker` on the same queue, or use `osonbot.update_queue.run_pipeline`.
+        """
+        self._log_started()
+        queue = UpdateQueue(queue_path)
+        offset = queue.offset()
+        while True:
+            try:
+                updates = self.get_updates(offset, timeout=poll_timeout)
+                if updates:
+                    # Stored before the offset moves on, so a crash here refetches instead of losing updates
+                    queue.put(updates)
+                    offset = updates[-1]['update_id'] + 1
+            except CircuitOpenError as e:
+                time.sleep(e.retry_in)
+            except Exception as e:
+                self.logger.error("Error occured", exc_info=True)
+                time.sleep(1)
+
+    def run_worker(self, queue_path: str = "updates.db", worker: str = None, idle_sleep: float = 0.2):
+        """
+        Handle updates stored in the queue at `queue_path` by a fetcher.
+        Updates of one chat are handled in order, failed updates are retried by any worker.
+        """
+        worker = worker or f"worker-{os.getpid()}"
+        queue = UpdateQueue(queue_path)
+        self.logger.info(f"[{worker}] waiting for updates from {queue_path}")
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                time.sleep(idle_sleep)
+                continue
+
+            id, update, lease = claimed
+            try:
+                with queue.keep_alive(id, lease):
+                    self.process_update(update)
+            except CircuitOpenError as e:
+                # Telegram is down, not the update's fault: hand it back without using up an attempt
+                queue.nack(id, lease, count_attempt=False)
+                time.sleep(e.retry_in)
+            except Exception as e:
+                self.logger.error(f"[{worker}] Error occured while handling update {update.get('update_id')}", exc_info=True)
+                queue.nack(id, lease)
+            else:
+                if not queue.ack(id, lease):
+                    self.logger.warning(f"[{worker}] lease on update {update.get('update_id')} was lost, it may be handled twice")
@@ -0,0 +1,254 @@
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+import httpx
+from .utils import TelegramAPIError, NetworkError, CircuitOpenError
+
+
+# Methods that can be sent twice with the same effect and the same answer. Others are
+# only retried when the request surely did not reach Telegram. Edits and
+# answerCallbackQuery are left out: when the first try went through, the second one
+# fails with "message is not modified" or "query is too old" and a working call would
+# look failed.
+IDEMPOTENT_METHODS = {
+    "getMe", "getUpdates", "getFile", "getChat", "getChatMember", "getChatMemberCount",
+    "getUserProfilePhotos", "getMyCommands", "getWebhookInfo", "setMyCommands", "setWebhook", "deleteWebhook",
+}
+
+DEFAULT_TIMEOUTS = {
+    "default": 10,
+    "sendPhoto": 60,
+    "sendVideo": 120,
+    "sendAudio": 120,
+    "sendVoice": 60,
+    "sendDocument": 120,
+    "download": 120,
+}
+
+
+class CircuitBreaker:
+    """
+    Stops calls after `failure_threshold` failures in a row. After `reset_timeout`
+    seconds one trial call is let through, its result closes or reopens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return
+            raise CircuitOpenError(max(0.0, self.opened_at + self.reset_timeout - time.monotonic()))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def release(self):
+        """End a call that says nothing about Telegram's health, such as one that failed before it was sent."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class Transport:
+    """
+    Sends Bot API requests for Bot. Adds per-method timeouts, retries with jittered
+    exponential backoff and a circuit breaker, and turns API errors into TelegramAPIError.
+    Flood-control waits (429 retry_after) up to `max_retry_after` seconds are slept
+    through, longer ones raise right away.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        base_url: str = "https://api.telegram.org",
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 10,
+        max_retry_after: float = 30,
+        timeouts: dict = None,
+        breaker: CircuitBreaker = None,
+        logger=None
+    ):
+        base_url = base_url.rstrip("/")
+        self.api_url = f"{base_url}/bot{token}/"
+        self.file_url = f"{base_url}/file/bot{token}/"
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.breaker = breaker or CircuitBreaker()
+        self.logger = logger
+        self.client = httpx.Client()
+
+    def _timeout(self, method: str, timeout: float = None):
+        read = timeout if timeout is not None else self.timeouts.get(method, self.timeouts["default"])
+        return httpx.Timeout(read, connect=5)
+
+    def _sleep(self, attempt: int, retry_after: float = None):
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            # Full jitter keeps many workers from retrying at the same moment
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        time.sleep(delay)
+
+    def _log_retry(self, method: str, attempt: int, error):
+        if self.logger:
+            self.logger.warning(f"{method} failed ({error}), retry {attempt + 1}/{self.retries}")
+
+    def _body(self, response):
+        """The JSON answer as a dict, or None when Telegram (or a proxy in front of it) sent something else."""
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+        return body if isinstance(body, dict) else None
+
+    def call(self, method: str, params: dict = None, data: dict = None, files: dict = None, timeout: float = None):
+        """
+        Call a Bot API method and return its `result`.
+        `params` is sent as JSON, `data` and `files` as multipart form.
+        """
+        idempotent = method in IDEMPOTENT_METHODS
+        if data is not None:
+            # Multipart fields must be strings, reply markups are sent as JSON
+            data = {k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in data.items() if v is not None}
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            # Only answers from Telegram and network errors say whether Telegram is healthy.
+            # Anything else (bad params, a bug) just frees the half-open trial slot
+            healthy = None
+            retry_after = None
+            try:
+                for f in (files or {}).values():
+                    if hasattr(f, "seek"):
+                        f.seek(0)
+                try:
+                    if files is not None or data is not None:
+                        response = self.client.post(self.api_url + method, data=data, files=files, timeout=self._timeout(method, timeout))
+                    else:
+                        response = self.client.post(self.api_url + method, json=params or {}, timeout=self._timeout(method, timeout))
+                except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                    # The request never left, so any method is safe to send again
+                    error = NetworkError(f"{method}: {e}")
+                    error.__cause__ = e
+                    healthy = False
+                    retryable = True
+                except httpx.HTTPError as e:
+                    error = NetworkError(f"{method}: {e}")
+                    error.__cause__ = e
+                    healthy = False
+                    retryable = idempotent
+                else:
+                    body = self._body(response)
+                    if body is None:
+                        error = TelegramAPIError(method, response.status_code, f"Unexpected response: {response.text[:200]}")
+                        healthy = False
+                        retryable = idempotent
+                    elif body.get("ok"):
+                        healthy = True
+                        return body.get("result")
+                    else:
+                        parameters = body.get("parameters")
+                        error = TelegramAPIError(
+                            method,
+                            body.get("error_code", response.status_code),
+                            body.get("description", ""),
+                            parameters.get("retry_after") if isinstance(parameters, dict) else None
+                        )
+                        if error.error_code == 429:
+                            # Flood control, Telegram did not run the request
+                            # Waits longer than max_retry_after are left to the caller instead of blocking this thread
+                            healthy = True
+                            retry_after = error.retry_after
+                            retryable = retry_after is None or retry_after <= self.max_retry_after
+                        elif error.error_code >= 500:
+                            healthy = False
+                            retryable = idempotent
+                        else:
+                            # Other client errors are our fault, Telegram itself is fine
+                            healthy = True
+                            retryable = False
+            finally:
+                if healthy:
+                    self.breaker.record_success()
+                elif healthy is False:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.release()
+
+            if not retryable or attempt >= self.retries:
+                raise error
+            self._log_retry(method, attempt, error)
+            self._sleep(attempt, retry_after)
+            attempt += 1
+
+    @contextmanager
+    def stream(self, file_path: str):
+        """
+        Open a download of `file_path`. Connecting is retried, but once the body
+        is being read errors are raised, since part of it may already be written.
+        """
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                request = self.client.build_request("GET", self.file_url + file_path, timeout=self._timeout("download"))
+                response = self.client.send(request, stream=True)
+            except httpx.HTTPError as e:
+                error = e
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                if response.status_code < 500:
+                    break
+                response.close()
+                error = f"status {response.status_code}"
+
+            self.breaker.record_failure()
+            if attempt >= self.retries:
+                raise NetworkError(f"download: {error}")
+            self._log_retry("download", attempt, error)
+            self._sleep(attempt)
+            attempt += 1
+
+        try:
+            self.breaker.record_success()
+            if response.status_code >= 400:
+                raise TelegramAPIError("download", response.status_code, f"Could not download {file_path}")
+            yield response
+        finally:
+            response.close()
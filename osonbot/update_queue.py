@@ -0,0 +1,302 @@
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from typing import Callable, Optional
+from .utils import setup_logger
+
+
+class UpdateQueue:
+    """
+    Durable update queue stored in a WAL-mode SQLite file.
+
+    One fetcher process puts updates in, any number of worker processes claim
+    them. Updates of the same chat are handed out one at a time and in order,
+    a claimed update is leased to its worker until it is acked, and an update
+    whose lease expires (worker crashed or hung) is delivered again. Every claim
+    gets its own lease token, so a worker whose lease was taken over can no
+    longer ack, nack or extend it.
+    """
+
+    def __init__(self, path: str = "updates.db", lease_timeout: float = 60, max_attempts: int = 5):
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS updates (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    update_id INTEGER UNIQUE,
+                    chat_id INTEGER,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease TEXT,
+                    lease_until REAL
+                );
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(updates);")}
+            if "lease" not in columns:
+                conn.execute("ALTER TABLE updates ADD COLUMN lease TEXT;")
+            conn.execute("CREATE INDEX IF NOT EXISTS updates_chat ON updates (chat_id, status, id);")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);")
+            # One row per chat with unfinished updates: its first unfinished update and that update's lease.
+            # Claims only look at these heads, so a long backlog of one chat costs nothing to skip.
+            # Updates without a chat get a row each (chat_id NULL), they are not ordered against anything.
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chats';").fetchone()
+            if not exists:
+                conn.execute("BEGIN IMMEDIATE;")
+                conn.execute("CREATE TABLE chats (head_id INTEGER PRIMARY KEY, chat_id INTEGER UNIQUE, lease_until REAL);")
+                conn.execute(
+                    """
+                    INSERT INTO chats (head_id, chat_id, lease_until)
+                    SELECT u.id, u.chat_id, CASE WHEN u.status = 'leased' THEN u.lease_until END FROM updates AS u
+                    WHERE u.status IN ('pending', 'leased') AND (u.chat_id IS NULL OR u.id = (
+                        SELECT MIN(o.id) FROM updates AS o WHERE o.chat_id = u.chat_id AND o.status IN ('pending', 'leased')
+                    ));
+                    """
+                )
+                conn.execute("COMMIT;")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        return conn
+
+    @staticmethod
+    def chat_id_of(update: dict) -> Optional[int]:
+        if "callback_query" in update:
+            message = update['callback_query'].get("message", {})
+            return message.get("chat", {}).get("id") or update['callback_query']['from']['id']
+        for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+            if key in update:
+                return update[key]['chat']['id']
+        return None
+
+    def put(self, updates: list[dict]):
+        """Store fetched updates. Updates already in the queue are ignored."""
+        rows = [(u['update_id'], self.chat_id_of(u), json.dumps(u)) for u in updates]
+        if not rows:
+            return
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            for row in rows:
+                cur = conn.execute("INSERT OR IGNORE INTO updates (update_id, chat_id, payload) VALUES (?, ?, ?);", row)
+                if cur.rowcount == 1:
+                    # Becomes the chat's head only if the chat has nothing unfinished yet
+                    conn.execute(
+                        "INSERT INTO chats (head_id, chat_id) VALUES (?, ?) ON CONFLICT(chat_id) DO NOTHING;",
+                        (cur.lastrowid, row[1])
+                    )
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('offset', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER));",
+                (max(r[0] for r in rows) + 1,)
+            )
+            conn.execute("COMMIT;")
+
+    def offset(self) -> int:
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'offset';").fetchone()
+            return int(row[0]) if row else 0
+
+    def _advance(self, conn, head_id: int, chat_id: Optional[int]):
+        """Move the chat's head past `head_id`, which just finished, or drop the chat when nothing is left."""
+        next_id = None
+        if chat_id is not None:
+            next_id = conn.execute(
+                "SELECT MIN(id) FROM updates WHERE chat_id = ? AND status = 'pending' AND id > ?;",
+                (chat_id, head_id)
+            ).fetchone()[0]
+        if next_id is None:
+            conn.execute("DELETE FROM chats WHERE head_id = ?;", (head_id,))
+        else:
+            conn.execute("UPDATE chats SET head_id = ?, lease_until = NULL WHERE head_id = ?;", (next_id, head_id))
+
+    def claim(self, worker: str) -> Optional[tuple[int, dict, str]]:
+        """
+        Lease the next deliverable update to `worker`.
+        An update is deliverable when no earlier update of the same chat is still unfinished.
+        Returns (id, update, lease) or None when there is nothing to do.
+        """
+        now = time.time()
+        lease = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            while True:
+                # Oldest head that is not leased, only chats busy right now are skipped
+                head = conn.execute(
+                    "SELECT head_id FROM chats WHERE lease_until IS NULL OR lease_until < ? ORDER BY head_id LIMIT 1;",
+                    (now,)
+                ).fetchone()
+                if head is None:
+                    conn.execute("COMMIT;")
+                    return None
+
+                id, chat_id, payload, status, attempts = conn.execute(
+                    "SELECT id, chat_id, payload, status, attempts FROM updates WHERE id = ?;", (head[0],)
+                ).fetchone()
+                if status == 'leased' and attempts >= self.max_attempts:
+                    # Updates that keep crashing their workers are parked instead of blocking their chat forever
+                    conn.execute("UPDATE updates SET status = 'dead', lease = NULL, lease_until = NULL WHERE id = ?;", (id,))
+                    self._advance(conn, id, chat_id)
+                    continue
+
+                lease_until = now + self.lease_timeout
+                conn.execute(
+                    "UPDATE updates SET status = 'leased', attempts = attempts + 1, worker = ?, lease = ?, lease_until = ? WHERE id = ?;",
+                    (worker, lease, lease_until, id)
+                )
+                conn.execute("UPDATE chats SET lease_until = ? WHERE head_id = ?;", (lease_until, id))
+                conn.execute("COMMIT;")
+                return id, json.loads(payload), lease
+
+    def extend(self, id: int, lease: str) -> bool:
+        """Push the lease `lease_timeout` further. Returns False if the lease is no longer held."""
+        lease_until = time.time() + self.lease_timeout
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            cur = conn.execute(
+                "UPDATE updates SET lease_until = ? WHERE id = ? AND lease = ? AND status = 'leased';",
+                (lease_until, id, lease)
+            )
+            if cur.rowcount == 1:
+                conn.execute("UPDATE chats SET lease_until = ? WHERE head_id = ?;", (lease_until, id))
+            conn.execute("COMMIT;")
+            return cur.rowcount == 1
+
+    def ack(self, id: int, lease: str) -> bool:
+        """Remove a handled update. Returns False if the lease was lost and the ack was ignored."""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            row = conn.execute("SELECT chat_id FROM updates WHERE id = ? AND lease = ? AND status = 'leased';", (id, lease)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM updates WHERE id = ?;", (id,))
+                self._advance(conn, id, row[0])
+            conn.execute("COMMIT;")
+            return row is not None
+
+    def nack(self, id: int, lease: str, count_attempt: bool = True) -> bool:
+        """
+        Give the update back so it is delivered again, or park it once it ran out of attempts.
+        With `count_attempt=False` the failed try does not count towards `max_attempts`.
+        Returns False if the lease was lost and the nack was ignored.
+        """
+        uncount = 0 if count_attempt else 1
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            row = conn.execute(
+                "SELECT chat_id, attempts - ? FROM updates WHERE id = ? AND lease = ? AND status = 'leased';",
+                (uncount, id, lease)
+            ).fetchone()
+            if row is not None:
+                chat_id, attempts = row
+                dead = attempts >= self.max_attempts
+                conn.execute(
+                    "UPDATE updates SET attempts = ?, status = ?, worker = NULL, lease = NULL, lease_until = NULL WHERE id = ?;",
+                    (attempts, 'dead' if dead else 'pending', id)
+                )
+                if dead:
+                    self._advance(conn, id, chat_id)
+                else:
+                    conn.execute("UPDATE chats SET lease_until = NULL WHERE head_id = ?;", (id,))
+            conn.execute("COMMIT;")
+            return row is not None
+
+    @contextmanager
+    def keep_alive(self, id: int, lease: str):
+        """Extend the lease in the background while the body runs, so slow handlers are not redelivered."""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease_timeout / 3):
+                if not self.extend(id, lease):
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def size(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM updates WHERE status != 'dead';").fetchone()[0]
+
+    def dead(self) -> list[dict]:
+        with self._connect() as conn:
+            return [json.loads(row[0]) for row in conn.execute("SELECT payload FROM updates WHERE status = 'dead' ORDER BY id;")]
+
+
+def _fetcher_main(bot_factory: Callable, queue_path: str):
+    bot = bot_factory()
+    bot.run_fetcher(queue_path)
+
+
+def _worker_main(bot_factory: Callable, queue_path: str, worker: str):
+    bot = bot_factory()
+    bot.run_worker(queue_path, worker=worker)
+
+
+def run_pipeline(bot_factory: Callable, queue_path: str = "updates.db", workers: int = None, max_restart_delay: float = 300):
+    """
+    Run one fetcher and `workers` worker processes sharing the queue at `queue_path`.
+    Processes that die are started again after a delay that doubles with every quick
+    crash (up to `max_restart_delay`), the queue redelivers whatever they were handling.
+
+    Args:
+        bot_factory: Module level function returning a configured Bot. It is called
+                     once in every process, so each worker builds its own handlers.
+        queue_path: SQLite file used as the queue
+        workers: Number of worker processes, defaults to the number of CPUs
+        max_restart_delay: Longest wait in seconds before restarting a crashing process
+    """
+    logger = setup_logger("osonbot.pipeline")
+    workers = workers or multiprocessing.cpu_count()
+    UpdateQueue(queue_path)
+
+    targets = {"fetcher": (_fetcher_main, (bot_factory, queue_path))}
+    for i in range(workers):
+        targets[f"worker-{i}"] = (_worker_main, (bot_factory, queue_path, f"worker-{i}"))
+
+    processes = {}
+    started_at = {}
+    restart_delay = {name: 0 for name in targets}
+    restart_at = {name: 0 for name in targets}
+    try:
+        while True:
+            now = time.monotonic()
+            for name, (target, args) in targets.items():
+                process = processes.get(name)
+                if process is not None and not process.is_alive():
+                    # A process that ran for a while before dying starts over with no delay
+                    if now - started_at[name] > max_restart_delay:
+                        restart_delay[name] = 0
+                    restart_delay[name] = min(max_restart_delay, max(1, restart_delay[name] * 2))
+                    restart_at[name] = now + restart_delay[name]
+                    logger.error(f"[{name}] exited with code {process.exitcode}, restarting in {restart_delay[name]}s")
+                    processes[name] = None
+                    continue
+                if process is None and now >= restart_at[name]:
+                    process = multiprocessing.Process(target=target, args=args, name=name, daemon=True)
+                    process.start()
+                    processes[name] = process
+                    started_at[name] = now
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        running = [process for process in processes.values() if process is not None]
+        for process in running:
+            process.terminate()
+        for process in running:
+            process.join()
@@ -1,4 +1,7 @@
+import io
+import os
 import logging
+import tempfile
 from pydantic import BaseModel, Field
 
 
@@ -6,6 +9,31 @@ class FileNotFoundOrInvalidURLError(Exception):
     """Raised when a file does not exist or the provided URL is invalid."""
     pass
 
+class TelegramError(Exception):
+    """Base class for errors raised while talking to the Bot API."""
+    pass
+
+class TelegramAPIError(TelegramError):
+    """Raised when the Bot API answers with ok=false."""
+
+    def __init__(self, method: str, error_code: int, description: str, retry_after: int = None):
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+        super().__init__(f"{method} failed with {error_code}: {description}")
+
+class NetworkError(TelegramError):
+    """Raised when the Bot API could not be reached or did not answer in time."""
+    pass
+
+class CircuitOpenError(TelegramError):
+    """Raised instead of calling the Bot API while it keeps failing."""
+
+    def __init__(self, retry_in: float):
+        self.retry_in = retry_in
+        super().__init__(f"Bot API is failing, calls are paused for {retry_in:.1f}s")
+
 def KeyboardButton(*rows: list[str], resize_keyboard: bool = True, one_time_keyborad: bool = False):
     return {
         "keyboard": list(rows),
@@ -63,6 +91,71 @@ class Document:
         self.file_id = file_id
 
 
+class File:
+    """
+    Handle to a file users sent to the bot. Nothing is downloaded until
+    `path`, `read` or `download` is used, then the bot's file cache is used.
+    With `cache_dir=None`, `read` streams into memory and `path` downloads to a temporary file.
+    """
+
+    def __init__(self, bot, file_id, file_unique_id=None, file_size=None, file_name=None, mime_type=None):
+        self.bot = bot
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
+        self.file_name = file_name
+        self.mime_type = mime_type
+        self._path = None
+
+    @classmethod
+    def from_message(cls, bot, media: dict | list):
+        # Photos come as a list of sizes, the last one is the biggest
+        if isinstance(media, list):
+            media = media[-1]
+        return cls(
+            bot,
+            media['file_id'],
+            file_unique_id=media.get('file_unique_id'),
+            file_size=media.get('file_size'),
+            file_name=media.get('file_name'),
+            mime_type=media.get('mime_type')
+        )
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            if self.bot.cache_dir is None:
+                # Without a cache the file goes to a temporary file the caller may delete
+                suffix = os.path.splitext(self.file_name or "")[1]
+                fd, tmp = tempfile.mkstemp(prefix="osonbot-", suffix=suffix)
+                os.close(fd)
+                try:
+                    self.bot.download(self, tmp)
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+                self._path = tmp
+            else:
+                self._path = self.bot.download(self)
+        return self._path
+
+    def download(self, destination=None):
+        if destination is None:
+            return self.path
+        return self.bot.download(self, destination)
+
+    def read(self) -> bytes:
+        if self._path is None and self.bot.cache_dir is None:
+            buffer = io.BytesIO()
+            self.bot.download(self, buffer)
+            return buffer.getvalue()
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def __repr__(self):
+        return f"File(file_id={self.file_id!r}, file_unique_id={self.file_unique_id!r}, file_size={self.file_size!r})"
+
+
 def setup_logger(name: str):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
@@ -0,0 +1,112 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import pytest
+
+
+class FakeTelegram:
+    """
+    Local stand-in for the Bot API. `faults` is consumed one entry per API call:
+    "500", "502" (HTML body), "429" (retry_after), "400", "hang", "notdict" or "ok".
+    Files in `files` are served from /file/bot<token>/<file_path>.
+    """
+
+    def __init__(self):
+        self.faults = []
+        self.retry_after = 0
+        self.hang = 1.0
+        self.calls = []
+        self.files = {}
+        self.file_gets = []
+        self.file_delay = 0
+        self.broken_files = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def count(self, method):
+        return sum(1 for m, _ in self.calls if m == method)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                file_path = path.split("/", 3)[3]
+                with fake.lock:
+                    fake.file_gets.append(file_path)
+                time.sleep(fake.file_delay)
+                if file_path in fake.broken_files:
+                    # Promise more than is sent, then hang up mid-body
+                    self.send_response(200)
+                    self.send_header("Content-Length", "100000")
+                    self.end_headers()
+                    self.wfile.write(b"x" * 10)
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                if file_path not in fake.files:
+                    return self._send(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                self._send(200, fake.files[file_path], "application/octet-stream")
+
+            def do_POST(self):
+                method = urlparse(self.path).path.rsplit("/", 1)[1]
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                body = json.loads(raw) if self.headers.get("Content-Type", "").startswith("application/json") else raw
+                with fake.lock:
+                    fake.calls.append((method, body))
+                    fault = fake.faults.pop(0) if fake.faults else "ok"
+
+                if fault == "hang":
+                    time.sleep(fake.hang)
+                elif fault == "500":
+                    return self._send(500, {"ok": False, "error_code": 500, "description": "Internal Server Error"})
+                elif fault == "502":
+                    return self._send(502, b"<html>502 Bad Gateway</html>", "text/html")
+                elif fault == "429":
+                    return self._send(429, {
+                        "ok": False, "error_code": 429, "description": "Too Many Requests",
+                        "parameters": {"retry_after": fake.retry_after}
+                    })
+                elif fault == "400":
+                    return self._send(400, {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"})
+                elif fault == "notdict":
+                    return self._send(200, [1, 2, 3])
+
+                if method == "getMe":
+                    return self._send(200, {"ok": True, "result": {"id": 1, "is_bot": True, "username": "test_bot"}})
+                if method == "getFile":
+                    file_id = body['file_id']
+                    return self._send(200, {"ok": True, "result": {
+                        "file_id": file_id, "file_unique_id": f"U{file_id}", "file_path": f"documents/{file_id}"
+                    }})
+                self._send(200, {"ok": True, "result": {"method": method}})
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def telegram():
+    fake = FakeTelegram()
+    yield fake
+    fake.close()
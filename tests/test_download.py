@@ -0,0 +1,100 @@
+import io
+import os
+import pytest
+from osonbot import Bot, File, Photo
+
+
+@pytest.fixture
+def bot(telegram, tmp_path):
+    bot = Bot("TOKEN", auto_db=False, base_url=telegram.url, cache_dir=str(tmp_path / "files"))
+    bot.transport.backoff = 0.01
+    return bot
+
+
+def test_concurrent_downloads_of_one_file_make_one_get(bot, telegram):
+    telegram.files["documents/F"] = b"a" * 100000
+    telegram.file_delay = 0.2
+
+    paths = bot.download_many([File(bot, "F", file_unique_id="UF") for _ in range(4)])
+
+    assert len(set(paths)) == 1
+    assert telegram.file_gets == ["documents/F"]
+    assert telegram.count("getFile") == 1
+    assert bot._download_locks == {}
+
+
+def test_second_download_is_cache_hit(bot, telegram):
+    telegram.files["documents/F"] = b"content"
+
+    first = bot.download("F")
+    second = bot.download(File(bot, "F", file_unique_id="UF"))
+
+    assert first == second
+    assert len(telegram.file_gets) == 1
+    assert telegram.count("getFile") == 1
+
+
+def test_download_to_buffer_and_path(bot, telegram, tmp_path):
+    telegram.files["documents/F"] = b"0123456789" * 1000
+
+    buffer = io.BytesIO()
+    assert bot.download("F", buffer, chunk_size=100) is buffer
+    assert buffer.getvalue() == b"0123456789" * 1000
+
+    target = tmp_path / "copy.bin"
+    bot.download("F", str(target))
+    assert target.read_bytes() == b"0123456789" * 1000
+
+
+def test_download_without_cache(telegram, tmp_path):
+    bot = Bot("TOKEN", auto_db=False, base_url=telegram.url, cache_dir=None)
+    telegram.files["documents/F"] = b"content"
+
+    file = File(bot, "F")
+    assert file.read() == b"content"
+    path = file.path
+    try:
+        with open(path, 'rb') as f:
+            assert f.read() == b"content"
+    finally:
+        os.remove(path)
+    assert len(telegram.file_gets) == 2
+
+
+def test_failed_download_removes_part_file(bot, telegram):
+    telegram.broken_files.add("documents/F")
+
+    with pytest.raises(Exception):
+        bot.download("F")
+
+    assert os.listdir(bot.cache_dir) == []
+    assert bot._download_locks == {}
+
+
+def test_lazy_file_handle_in_media_handler(bot, telegram):
+    telegram.files["documents/big"] = b"photo"
+    received = []
+    bot.when(Photo, lambda message: received.append(message['file']) or "thanks")
+
+    bot.process_messages({
+        "message_id": 1,
+        "from": {"id": 5, "first_name": "A", "username": "a"},
+        "chat": {"id": 5, "first_name": "A"},
+        "photo": [{"file_id": "small", "file_unique_id": "Usmall"}, {"file_id": "big", "file_unique_id": "Ubig"}],
+    })
+
+    assert received[0].file_id == "big"
+    assert telegram.file_gets == []
+    assert received[0].read() == b"photo"
+    assert telegram.count("sendMessage") == 1
+
+
+def test_media_message_without_handler_does_not_raise(bot, telegram):
+    bot.process_messages({
+        "message_id": 1,
+        "from": {"id": 5, "first_name": "A", "username": "a"},
+        "chat": {"id": 5, "first_name": "A"},
+        "video": {"file_id": "V", "file_unique_id": "UV"},
+    })
+
+    assert telegram.calls == []
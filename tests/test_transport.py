@@ -0,0 +1,240 @@
+import socket
+import time
+import pytest
+from osonbot import Bot, TelegramAPIError, NetworkError, CircuitOpenError
+
+
+@pytest.fixture
+def bot(telegram):
+    bot = Bot("TOKEN", auto_db=False, base_url=telegram.url, timeouts={"default": 0.3}, max_retry_after=1)
+    bot.transport.backoff = 0.01
+    bot.transport.breaker.reset_timeout = 0.2
+    return bot
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_idempotent_method_is_retried_on_500(bot, telegram):
+    telegram.faults = ["500"] * 10
+
+    with pytest.raises(TelegramAPIError) as e:
+        bot.transport.call("getChat", {"chat_id": 1})
+
+    assert e.value.error_code == 500
+    assert telegram.count("getChat") == 4
+
+
+def test_edit_is_not_resent_after_it_may_have_been_applied(bot, telegram):
+    telegram.faults = ["500"]
+    with pytest.raises(TelegramAPIError):
+        bot.edit_message_text(1, 2, "text")
+    assert telegram.count("editMessageText") == 1
+
+    telegram.faults = ["hang"]
+    with pytest.raises(NetworkError):
+        bot.edit_message_text(1, 2, "text")
+    assert telegram.count("editMessageText") == 2
+
+
+def test_send_message_is_not_sent_twice_on_500(bot, telegram):
+    telegram.faults = ["500"]
+
+    with pytest.raises(TelegramAPIError) as e:
+        bot.send_message(1, "text")
+
+    assert e.value.error_code == 500
+    assert telegram.count("sendMessage") == 1
+
+
+def test_retry_recovers_after_server_errors(bot, telegram):
+    telegram.faults = ["500", "502"]
+
+    assert bot.get_me()['username'] == "test_bot"
+    assert telegram.count("getMe") == 3
+
+
+def test_html_bad_gateway_is_structured(bot, telegram):
+    telegram.faults = ["502"] * 10
+
+    with pytest.raises(TelegramAPIError) as e:
+        bot.get_me()
+
+    assert e.value.error_code == 502
+    assert "Bad Gateway" in e.value.description
+
+
+def test_flood_control_is_retried_for_any_method(bot, telegram):
+    telegram.faults = ["429"]
+
+    assert bot.send_message(1, "text") == {"method": "sendMessage"}
+    assert telegram.count("sendMessage") == 2
+
+
+def test_long_flood_control_wait_raises_immediately(bot, telegram):
+    telegram.faults = ["429"]
+    telegram.retry_after = 600
+
+    started = time.monotonic()
+    with pytest.raises(TelegramAPIError) as e:
+        bot.send_message(1, "text")
+
+    assert time.monotonic() - started < 1
+    assert e.value.error_code == 429
+    assert e.value.retry_after == 600
+    assert telegram.count("sendMessage") == 1
+
+
+def test_client_error_is_not_retried(bot, telegram):
+    telegram.faults = ["400"]
+
+    with pytest.raises(TelegramAPIError) as e:
+        bot.send_message(1, "text")
+
+    assert e.value.error_code == 400
+    assert e.value.method == "sendMessage"
+    assert e.value.description == "Bad Request: chat not found"
+    assert telegram.count("sendMessage") == 1
+    assert bot.transport.breaker.failures == 0
+
+
+def test_timeout_retries_only_idempotent_methods(bot, telegram):
+    telegram.faults = ["hang"]
+    with pytest.raises(NetworkError):
+        bot.send_message(1, "text")
+    assert telegram.count("sendMessage") == 1
+
+    telegram.faults = ["hang"]
+    assert bot.get_me()['id'] == 1
+    assert telegram.count("getMe") == 2
+
+
+def test_refused_connection_is_retried_and_raised(telegram):
+    bot = Bot("TOKEN", auto_db=False, base_url=f"http://127.0.0.1:{closed_port()}")
+    bot.transport.backoff = 0.01
+
+    with pytest.raises(NetworkError):
+        bot.send_message(1, "text")
+
+    assert bot.transport.breaker.failures == 4
+
+
+def test_breaker_opens_and_closes_after_half_open_trial(bot, telegram):
+    breaker = bot.transport.breaker
+    telegram.faults = ["500"] * 5
+    for _ in range(5):
+        with pytest.raises(TelegramAPIError):
+            bot.send_message(1, "text")
+    assert breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        bot.send_message(1, "text")
+    assert telegram.count("sendMessage") == 5
+
+    time.sleep(0.25)
+    assert breaker.state == "half-open"
+    assert bot.send_message(1, "text") == {"method": "sendMessage"}
+    assert breaker.state == "closed"
+
+
+def test_failed_half_open_trial_reopens_breaker(bot, telegram):
+    breaker = bot.transport.breaker
+    telegram.faults = ["500"] * 5
+    for _ in range(5):
+        with pytest.raises(TelegramAPIError):
+            bot.send_message(1, "text")
+
+    time.sleep(0.25)
+    telegram.faults = ["500"]
+    with pytest.raises(TelegramAPIError):
+        bot.send_message(1, "text")
+    assert breaker.state == "open"
+
+
+def test_unexpected_body_on_trial_does_not_stick_half_open(bot, telegram):
+    breaker = bot.transport.breaker
+    telegram.faults = ["500"] * 5
+    for _ in range(5):
+        with pytest.raises(TelegramAPIError):
+            bot.send_message(1, "text")
+
+    time.sleep(0.25)
+    telegram.faults = ["notdict"]
+    with pytest.raises(TelegramAPIError):
+        bot.send_message(1, "text")
+    assert breaker.state == "open"
+
+    time.sleep(0.25)
+    assert bot.send_message(1, "text") == {"method": "sendMessage"}
+    assert breaker.state == "closed"
+
+
+def test_local_errors_do_not_open_breaker(bot, telegram):
+    breaker = bot.transport.breaker
+    for _ in range(6):
+        with pytest.raises(TypeError):
+            bot.send_message(1, {1, 2})
+
+    assert telegram.calls == []
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+    assert bot.send_message(1, "ok") == {"method": "sendMessage"}
+
+
+def test_local_error_on_trial_frees_half_open_slot(bot, telegram):
+    breaker = bot.transport.breaker
+    telegram.faults = ["500"] * 5
+    for _ in range(5):
+        with pytest.raises(TelegramAPIError):
+            bot.send_message(1, "text")
+
+    time.sleep(0.25)
+    with pytest.raises(TypeError):
+        bot.send_message(1, {1, 2})
+    assert breaker.state == "half-open"
+    assert bot.send_message(1, "ok") == {"method": "sendMessage"}
+    assert breaker.state == "closed"
+
+
+def test_document_file_id_is_sent_as_is(bot, telegram):
+    bot.send_document(1, "BQACAgIAAx")
+
+    method, body = telegram.calls[-1]
+    assert method == "sendDocument"
+    assert body['document'] == "BQACAgIAAx"
+
+
+def test_upload_sends_reply_markup_as_json(bot, telegram, tmp_path):
+    photo = tmp_path / "photo.jpg"
+    photo.write_bytes(b"jpeg")
+
+    bot.send_photo(1, str(photo), reply_markup={"remove_keyboard": True})
+
+    method, body = telegram.calls[-1]
+    assert method == "sendPhoto"
+    assert b'{"remove_keyboard": true}' in body
+    assert b"jpeg" in body
+
+
+def test_failing_update_does_not_stop_batch(bot, telegram):
+    bot.when("/start", "hello")
+    updates = [
+        {"update_id": 1, "message": {"message_id": 1, "chat": {"id": 1}}},
+        {"update_id": 2, "message": {"message_id": 2, "from": {"id": 1, "username": "a"}, "chat": {"id": 1}, "text": "/start"}},
+    ]
+
+    def get_updates(offset, timeout=0):
+        # Stop run() once the batch has been handled
+        if offset:
+            raise KeyboardInterrupt
+        return updates
+
+    bot.get_updates = get_updates
+
+    with pytest.raises(KeyboardInterrupt):
+        bot.run()
+
+    assert telegram.count("sendMessage") == 1
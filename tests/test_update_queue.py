@@ -0,0 +1,155 @@
+import time
+import pytest
+from osonbot.update_queue import UpdateQueue
+
+
+def message(update_id, chat_id):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": "hi"}}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return UpdateQueue(str(tmp_path / "updates.db"), lease_timeout=0.2, max_attempts=2)
+
+
+def test_same_chat_waits_for_earlier_update(queue):
+    queue.put([message(1, 10), message(2, 10), message(3, 20)])
+
+    first = queue.claim("w1")
+    second = queue.claim("w2")
+    assert first[1]['update_id'] == 1
+    # Update 2 is blocked by the leased update 1, chat 20 is not
+    assert second[1]['update_id'] == 3
+    assert queue.claim("w3") is None
+
+    queue.ack(first[0], first[2])
+    assert queue.claim("w3")[1]['update_id'] == 2
+
+
+def test_pending_update_blocks_later_ones_of_its_chat(queue):
+    queue.put([message(1, 10), message(2, 10)])
+    id, update, lease = queue.claim("w1")
+    queue.nack(id, lease)
+
+    # Update 1 is pending again, so it is delivered before update 2
+    assert queue.claim("w2")[1]['update_id'] == 1
+    assert queue.claim("w3") is None
+
+
+def test_expired_lease_is_redelivered(queue):
+    queue.put([message(1, 10)])
+    id, update, lease = queue.claim("w1")
+    assert queue.claim("w2") is None
+
+    time.sleep(0.25)
+    redelivered = queue.claim("w2")
+    assert redelivered[0] == id
+    assert redelivered[2] != lease
+
+
+def test_stale_worker_cannot_touch_taken_over_lease(queue):
+    queue.put([message(1, 10), message(2, 10)])
+    id, update, stale = queue.claim("w1")
+    time.sleep(0.25)
+    _, _, lease = queue.claim("w2")
+
+    assert queue.nack(id, stale) is False
+    assert queue.ack(id, stale) is False
+    assert queue.extend(id, stale) is False
+    assert queue.dead() == []
+    assert queue.claim("w3") is None
+    assert queue.ack(id, lease) is True
+
+
+def test_keep_alive_prevents_redelivery(queue):
+    queue.put([message(1, 10)])
+    id, update, lease = queue.claim("w1")
+    with queue.keep_alive(id, lease):
+        time.sleep(0.5)
+        assert queue.claim("w2") is None
+    assert queue.ack(id, lease) is True
+
+
+def test_max_attempts_parks_update_as_dead(queue):
+    queue.put([message(1, 10), message(2, 10)])
+    for _ in range(2):
+        id, update, lease = queue.claim("w1")
+        assert update['update_id'] == 1
+        queue.nack(id, lease)
+
+    assert [u['update_id'] for u in queue.dead()] == [1]
+    # A dead update no longer blocks its chat
+    assert queue.claim("w1")[1]['update_id'] == 2
+
+
+def test_expired_lease_past_max_attempts_is_parked(queue):
+    queue.put([message(1, 10)])
+    id, update, lease = queue.claim("w1")
+    queue.nack(id, lease)
+    queue.claim("w1")
+    time.sleep(0.25)
+
+    assert queue.claim("w2") is None
+    assert [u['update_id'] for u in queue.dead()] == [1]
+
+
+def test_nack_without_counting_attempt(queue):
+    queue.put([message(1, 10)])
+    for _ in range(5):
+        id, update, lease = queue.claim("w1")
+        assert queue.nack(id, lease, count_attempt=False) is True
+
+    assert queue.dead() == []
+    assert queue.size() == 1
+
+
+def test_put_is_idempotent_and_offset_monotonic(queue):
+    assert queue.offset() == 0
+    queue.put([message(5, 10), message(6, 11)])
+    assert queue.offset() == 7
+
+    # A refetch after a fetcher crash stores nothing twice and never moves the offset back
+    queue.put([message(5, 10)])
+    assert queue.size() == 2
+    assert queue.offset() == 7
+
+    queue.put([])
+    assert queue.offset() == 7
+
+
+def test_callback_query_uses_message_chat(queue):
+    callback = {"update_id": 1, "callback_query": {"from": {"id": 3}, "message": {"chat": {"id": 10}}, "data": "x"}}
+    assert UpdateQueue.chat_id_of(callback) == 10
+
+
+def test_claim_stays_fast_behind_a_blocked_backlog(queue):
+    # One busy chat with a long queue in front of everyone else
+    queue.lease_timeout = 600
+    queue.put([message(i, 1) for i in range(1, 50001)])
+    queue.put([message(100000 + i, 1000 + i) for i in range(200)])
+    head = queue.claim("w0")
+    assert head[1]['update_id'] == 1
+
+    started = time.perf_counter()
+    claimed = [queue.claim(f"w{i}") for i in range(200)]
+    elapsed = time.perf_counter() - started
+
+    assert sorted(c[1]['message']['chat']['id'] for c in claimed) == list(range(1000, 1200))
+    assert queue.claim("w") is None
+    # Scanning the backlog took tens of milliseconds per claim, skipping it should take well under one
+    assert elapsed / 200 < 0.005
+
+
+def test_existing_queue_without_chats_table_is_migrated(tmp_path):
+    path = str(tmp_path / "updates.db")
+    queue = UpdateQueue(path)
+    queue.put([message(1, 10), message(2, 10), message(3, 20)])
+    id, update, lease = queue.claim("w1")
+    with queue._connect() as conn:
+        conn.execute("DROP TABLE chats;")
+
+    queue = UpdateQueue(path)
+    assert queue.claim("w2")[1]['update_id'] == 3
+    assert queue.claim("w3") is None
+    assert queue.ack(id, lease) is True
+    assert queue.claim("w3")[1]['update_id'] == 2